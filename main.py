@@ -1,12 +1,120 @@
 import streamlit as st
+import copy
+import gc
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 
-from utils.text_extractor import extract_text
-from utils.data_cleanser import anonymize_text
-from utils.content_interpreter import identify_client_name, interpret_content
+from utils.text_extractor import extract_text_cached, sheets_to_text
+from utils.data_cleanser import analyze_text_in_process, anonymize_texts, anonymize_dataframe, find_client_name_spans, find_redaction_tags, redact_for_prompt
+from utils.content_interpreter import analyze_document, assess_pii_sensitivity, find_labelled_client_name, select_prompt_passages
 
 
+# Upper bound on files processed concurrently; keeps Groq requests under the rate limit.
+MAX_WORKERS = 8
+# Run a full garbage collection after rendering this many reports, so large
+# batches release the memory of finished files (pages, parsed sheets) promptly.
+GC_EVERY_N_FILES = 4
+
+
+# PIPELINE FUNCTIONS
+
+
+def redact_report(report: dict, client_name: str) -> dict:
+    """
+    Redacts PII and the client name from the summary and findings of a report.
+    The LLM still sees organization names (to identify the client), and may
+    infer or echo other PII, so its wording is cleaned before display.
+    """
+    report = copy.deepcopy(report)
+    findings = report.get("detailed_findings") or {}
+    items = [item for category_items in findings.values() if category_items for item in category_items]
+
+    texts = [report.get("executive_summary", "")]
+    for item in items:
+        texts += [item["title"], item["description"]]
+    redacted = anonymize_texts(texts, client_name)
+
+    report["executive_summary"] = redacted[0]
+    for i, item in enumerate(items):
+        item["title"], item["description"] = redacted[1 + 2 * i], redacted[2 + 2 * i]
+    return report
+
+
+def process_one(file_bytes: bytes, name: str) -> dict:
+    """
+    Runs the full extract -> analyze -> anonymize pipeline for one file.
+    Renders nothing, so it is safe to run from a worker thread.
+
+    Args:
+        file_bytes: Raw contents of the uploaded file
+        name: Original file name (used to detect the file type)
+
+    Returns:
+        A dictionary with either an "error"/"warning" message or the
+        "client_name" and "analysis" for the file.
+    """
+    # PIPELINE STEP 1: Text Extraction
+    buffer = io.BytesIO(file_bytes)
+    buffer.name = name
+    extraction_result = extract_text_cached(buffer)
+    raw_text = extraction_result.get("text")
+    error = extraction_result.get("error")
+
+    # Check for extraction errors
+    if error:
+        return {"error": f"Could not process file. Reason: {error}"}
+
+    # Validate extracted text quality
+    if not raw_text or len(raw_text.strip()) < 10:
+        return {
+            "warning": "Very little text could be extracted. "
+                       "The file may be empty or the OCR quality is poor."
+        }
+
+    # PIPELINE STEP 2: PII Analysis, so the document is redacted before it reaches the LLM.
+    # The client is not known yet, so its occurrences are counted after step 3.
+    sheets = extraction_result.get("sheets")
+    try:
+        if sheets:
+            # Spreadsheets are analyzed per distinct cell value, and the prompt is built from the redacted cells
+            redacted_sheets = {sheet_name: anonymize_dataframe(df, "", for_prompt=True) for sheet_name, df in sheets.items()}
+            pii_count = sum(count for _, count in redacted_sheets.values())
+            prompt_text = sheets_to_text({sheet_name: df for sheet_name, (df, _) in redacted_sheets.items()})
+            tag_spans = find_redaction_tags(prompt_text)
+        else:
+            pii_spans = analyze_text_in_process(raw_text, "")
+            pii_count = len(pii_spans)
+            prompt_text, tag_spans = redact_for_prompt(raw_text, pii_spans)
+    except Exception as e:
+        # Without its PII spans the text can't be redacted, so it must not reach the LLM
+        return {"error": f"Could not analyze file for PII. Reason: {e}"}
+
+    # PIPELINE STEP 3: Client Identification & Content Analysis (one LLM call) on the
+    # redacted text; for long documents, only the passages around the most PII
+    report = analyze_document(select_prompt_passages(prompt_text, tag_spans))
+    if "error" in report:
+        return {"client_name": "Unknown", "analysis": report}
+    # "Unknown" is a placeholder, not a name to look for in the text
+    client_name = report["client_name"]
+    client_spans = find_client_name_spans(raw_text, client_name) if client_name != "Unknown" else []
+    if not client_spans:
+        # The model found no client, or named one that isn't in the document:
+        # fall back to an explicit "Client: ..." header line, if there is one
+        labelled_name = find_labelled_client_name(raw_text)
+        if labelled_name:
+            client_name = labelled_name
+            client_spans = find_client_name_spans(raw_text, client_name)
+    pii_count += len(client_spans)
+    client_term = "" if client_name == "Unknown" else client_name
+
+    # PIPELINE STEP 4: Anonymized Report
+    analysis_result = redact_report(report, client_term)
+    analysis_result["pii_sensitivity_level"] = assess_pii_sensitivity(pii_count)
+
+    return {"client_name": client_name, "analysis": analysis_result}
+
 
 # UI RENDERING FUNCTIONS
 
@@ -59,71 +167,75 @@ def display_report(file, result):
                         st.write(item['description'])
 
 # MAIN APPLICATION
-st.set_page_config(
-    layout="wide", 
-    page_title="Intelligent File Analyzer",
-    page_icon="🚀"
-)
-
-st.title("🚀 Intelligent File Analyzer")
-st.info(
-    "📤 Upload one or more documents. The AI will automatically identify the client, "
-    "cleanse the data, and generate a detailed security report for each file."
-)
-
-
-# File Upload Section
-uploaded_files = st.file_uploader(
-    "📁 Upload Documents for Analysis",
-    type=['pdf', 'png', 'jpeg', 'jpg', 'pptx', 'xlsx'],
-    accept_multiple_files=True
-)
-
-# Analysis Button & Processing Pipeline
-if st.button("🔬 Generate Intelligence Reports", type="primary"):
-    if not uploaded_files:
-        st.warning("⚠️ Please upload at least one file to begin analysis.")
-    else:
-        st.header("📊 Batch Analysis Results")
-        
-        for file in uploaded_files:
-            st.markdown("---")
-            
-            with st.spinner(f"⚙️ Processing {file.name}..."):
-                file_extension = os.path.splitext(file.name)[1].lower()
-
-                # PIPELINE STEP 1: Text Extraction
-                extraction_result = extract_text(file)
-                raw_text = extraction_result.get("text")
-                error = extraction_result.get("error")
-
-                # Check for extraction errors
-                if error:
-                    st.error(f"❌ **{file.name}**: Could not process file. Reason: {error}")
-                    continue
-
-                # Validate extracted text quality
-                if not raw_text or len(raw_text.strip()) < 10:
-                    st.warning(
-                        f"⚠️ **{file.name}**: Very little text could be extracted. "
-                        "The file may be empty or the OCR quality is poor."
-                    )
-                    continue
-
-                # PIPELINE STEP 2: Client Identification
-                client_name = identify_client_name(raw_text)
-                st.write(f"🏢 AI identified client for **{file.name}** as: **{client_name}**")
-                
-                # PIPELINE STEP 3: Data Anonymization
-                anonymized_text, pii_results = anonymize_text(raw_text, client_name)
-                pii_count = len(pii_results)
-                
-                # PIPELINE STEP 4: Content Analysis
-                analysis_result = interpret_content(anonymized_text, pii_count)
-
-                if "error" in analysis_result:
-                    st.error(f"❌ Could not analyze {file.name}: {analysis_result['error']}")
-                else:
-                    display_report(file, analysis_result)
-        
-        st.success("✅ Batch processing complete!")
+
+
+def main():
+    """Renders the upload page and runs the batch pipeline when requested."""
+    st.set_page_config(
+        layout="wide", 
+        page_title="Intelligent File Analyzer",
+        page_icon="🚀"
+    )
+
+    st.title("🚀 Intelligent File Analyzer")
+    st.info(
+        "📤 Upload one or more documents. The AI will automatically identify the client, "
+        "cleanse the data, and generate a detailed security report for each file."
+    )
+
+
+    # File Upload Section
+    uploaded_files = st.file_uploader(
+        "📁 Upload Documents for Analysis",
+        type=['pdf', 'png', 'jpeg', 'jpg', 'pptx', 'xlsx'],
+        accept_multiple_files=True
+    )
+
+    # Analysis Button & Processing Pipeline
+    if st.button("🔬 Generate Intelligence Reports", type="primary"):
+        if not uploaded_files:
+            st.warning("⚠️ Please upload at least one file to begin analysis.")
+        else:
+            st.header("📊 Batch Analysis Results")
+
+            # Streamlit's UploadedFile is not thread-safe, so read the bytes up front
+            # and hand only plain data to the worker threads.
+            with st.spinner(f"⚙️ Processing {len(uploaded_files)} file(s)..."):
+                with ThreadPoolExecutor(max_workers=min(len(uploaded_files), MAX_WORKERS)) as executor:
+                    futures = {
+                        executor.submit(process_one, file.getvalue(), file.name): file
+                        for file in uploaded_files
+                    }
+
+                    # Render each report on the script thread as soon as it is ready
+                    for done, future in enumerate(as_completed(futures), 1):
+                        # Drop the finished future so its result can be freed once rendered
+                        file = futures.pop(future)
+                        outcome = future.result()
+                        if done % GC_EVERY_N_FILES == 0:
+                            gc.collect()
+                        st.markdown("---")
+
+                        if "error" in outcome:
+                            st.error(f"❌ **{file.name}**: {outcome['error']}")
+                            continue
+
+                        if "warning" in outcome:
+                            st.warning(f"⚠️ **{file.name}**: {outcome['warning']}")
+                            continue
+
+                        st.write(f"🏢 AI identified client for **{file.name}** as: **{outcome['client_name']}**")
+
+                        analysis_result = outcome["analysis"]
+                        if "error" in analysis_result:
+                            st.error(f"❌ Could not analyze {file.name}: {analysis_result['error']}")
+                        else:
+                            display_report(file, analysis_result)
+
+            st.success("✅ Batch processing complete!")
+
+
+# Worker processes of the spawn-based pools (see utils.data_cleanser) re-import
+# this script as __mp_main__; only the Streamlit run renders the app.
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,28 @@
+import functools
 import os
+import re
+import threading
+from collections import Counter
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import List, Dict, Optional
 
+from utils.pipeline_cache import disk_cached
+
+# --- Groq concurrency limit ---
+# Files are processed on several threads at once; this caps how many Groq
+# requests are in flight so batch runs stay under the API rate limit.
+MAX_CONCURRENT_GROQ_REQUESTS = 6
+_GROQ_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_GROQ_REQUESTS)
+
+# --- Output token cap ---
+# Upper bound on generated tokens per request, so a runaway generation can't
+# hold a Groq slot for long. It leaves room for rule-heavy reports (e.g. long
+# firewall tables); a report cut off at the cap is reported as an error.
+ANALYSIS_MAX_TOKENS = 4096
+
 # --- Pydantic models for structured output (same as before) ---
 class Finding(BaseModel):
     """A model for a single, categorized finding."""
@@ -17,84 +35,181 @@ class CategorizedFindings(BaseModel):
     iam_policies: Optional[List[Finding]] = Field(None, description="A list of all extracted IAM policies.")
     security_observations: Optional[List[Finding]] = Field(None, description="Other notable security-related observations.")
 
-class IntelligentSummary(BaseModel):
-    """The final, detailed analysis report structure."""
+class DocumentReport(BaseModel):
+    """The client name and analysis of a document, produced by a single LLM call."""
+    client_name: str = Field(description="The primary company, organization, or client the document is about, or 'Unknown'.")
     executive_summary: str = Field(description="A two or three-sentence executive summary of the document's content and overall risk.")
-    pii_sensitivity_level: str = Field(description="An assessment of the PII risk level based on the count of PII found.", enum=["None", "Low", "Medium", "High", "Critical"])
     detailed_findings: CategorizedFindings = Field(description="A structured breakdown of all key findings, categorized appropriately.")
 
-# --- AI STEP 1: IDENTIFY THE CLIENT NAME ---
-def identify_client_name(text_to_analyze: str) -> str:
+# --- CLIENT NAME ---
+def _clean_client_name(client_name: str) -> str:
+    """Normalizes the raw LLM answer to a client name or 'Unknown'."""
+    client_name = client_name.strip().replace('"', '')
+    return client_name if client_name and client_name != "Unknown" else "Unknown"
+
+
+# Documents that label their client in a header line ("Client: Acme Corp",
+# "Prepared for Acme Corp") are matched locally by this pattern, as a fallback
+# when the LLM's answer can't be found in the text. Only the top of the document
+# is scanned, and the label must start its line and the name end it.
+CLIENT_LABEL_SCAN_CHARS = 4000
+_CLIENT_LABEL_PATTERN = re.compile(
+    r"^[ \t]*(?:Client|Customer)(?:[ \t]+Name)?[ \t]*:[ \t]*(?P<label>[A-Z][\w&.,' -]{1,60}?)[ \t\r]*$"
+    r"|^[ \t]*Prepared[ \t]+for[ \t]*:?[ \t]*(?P<prepared>[A-Z][\w&.,' -]{1,60}?)[ \t\r]*$",
+    re.MULTILINE
+)
+
+
+def find_labelled_client_name(text: str) -> Optional[str]:
     """
-    Uses a fast LLM call to find the most likely client/company name in the text.
+    Finds a client named by a labelled header line near the top of a document,
+    such as "Client: Acme Corp" or "Prepared for Acme Corp".
+
+    Returns:
+        The client name, or None if the document has no such line.
     """
-    if not text_to_analyze or not text_to_analyze.strip():
-        return "Unknown"
-    
-    try:
-        # A very focused prompt for a simple task
-        prompt = ChatPromptTemplate.from_template(
-            "Analyze the following document text. Identify the primary company, organization, or client that this document is about. Look for repeated company names in headers, footers, or titles. Respond with ONLY the single most likely company name, and nothing else. If you cannot determine the name with high confidence, respond with the word 'Unknown'."
-        )
-        llm = ChatGroq(temperature=0, model_name="llama-3.1-8b-instant")
-        # A simple string parser is enough for this task
-        chain = prompt | llm | StrOutputParser()
-        
-        client_name = chain.invoke({"input": text_to_analyze})
-        
-        # Clean up the output
-        client_name = client_name.strip().replace('"', '')
-        return client_name if client_name and client_name != "Unknown" else "Unknown"
-        
-    except Exception as e:
-        print(f"Error during client identification: {e}")
-        return "Unknown"
+    match = _CLIENT_LABEL_PATTERN.search(text[:CLIENT_LABEL_SCAN_CHARS])
+    if not match:
+        return None
+    client_name = _clean_client_name((match.group("label") or match.group("prepared")).strip(" ,-"))
+    return client_name if client_name != "Unknown" else None
+
+
+# --- PROMPT INPUT SELECTION ---
+# Groq bills and rate-limits by input tokens, which also dominate latency for
+# short answers, so long documents are cut down to their highest-signal passages.
+MAX_PROMPT_CHUNKS = 8
+PROMPT_CHUNK_CHARS = 2000  # ~500 tokens
+PROMPT_CONTEXT_CHARS = 200
+
+def select_prompt_passages(text: str, spans: List) -> str:
+    """
+    Cuts a long document down to at most MAX_PROMPT_CHUNKS passages for the LLM.
+    Shorter documents are returned unchanged.
+
+    Args:
+        text: The text of a document, as it will be sent to the LLM.
+        spans: PII spans (or redaction tags) in that text: anything with a .start
+            offset, such as Presidio RecognizerResults.
+
+    Returns:
+        The opening chunk (where titles and headers usually name the client) plus
+        the chunks with the most PII spans, each widened by PROMPT_CONTEXT_CHARS of
+        context and kept in document order. Overlapping windows are merged.
+    """
+    num_chunks = -(-len(text) // PROMPT_CHUNK_CHARS)
+    if num_chunks <= MAX_PROMPT_CHUNKS:
+        return text
+
+    span_counts = Counter(span.start // PROMPT_CHUNK_CHARS for span in spans)
+    chosen = [0] + [chunk for chunk, _ in span_counts.most_common() if chunk != 0]
+    # Without enough PII-bearing chunks, fill the budget from the top of the document
+    chosen += [chunk for chunk in range(num_chunks) if chunk not in chosen]
+    chosen = sorted(chosen[:MAX_PROMPT_CHUNKS])
 
-# --- AI STEP 2: PERFORM DETAILED ANALYSIS ---
-def interpret_content(text_to_analyze: str, pii_count: int) -> Dict:
+    windows = []
+    for chunk in chosen:
+        start = max(0, chunk * PROMPT_CHUNK_CHARS - PROMPT_CONTEXT_CHARS)
+        end = min(len(text), (chunk + 1) * PROMPT_CHUNK_CHARS + PROMPT_CONTEXT_CHARS)
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return "\n[...]\n".join(text[start:end] for start, end in windows)
+
+
+# --- FUSED AI STEP: IDENTIFY THE CLIENT AND ANALYZE IN ONE CALL ---
+# Bump when the prompt or DocumentReport schema changes, to invalidate cached reports.
+ANALYSIS_PROMPT_VERSION = "1"
+
+# Returned when there is no text to analyze, without calling the LLM.
+_EMPTY_ANALYSIS = {
+    "executive_summary": "No text could be extracted from the document for analysis.",
+    "pii_sensitivity_level": "None",
+    "detailed_findings": {}
+}
+
+
+# The chain is built once and shared by every call and thread (runnables are
+# stateless). Its ChatGroq keeps one HTTP client, so requests reuse its pooled
+# keep-alive connections instead of opening a new TLS connection per call.
+@functools.lru_cache(maxsize=None)
+def _build_report_chain():
+    """Builds the prompt -> LLM -> DocumentReport chain used by analyze_document."""
+    prompt_template = """
+    You are a Tier-3 cybersecurity analyst. Your task is to provide a detailed and factual analysis of a document.
+    Follow these steps precisely:
+    1.  Identify the Client: Identify the primary company, organization, or client that this document is about. Look for repeated company names in headers, footers, or titles. If you cannot determine the name with high confidence, use the word 'Unknown'.
+    2.  Extract Entities: Identify and extract ONLY specific security entities like Firewall Rules, IAM Policies, IP addresses, or hostnames.
+    3.  Generate Summary & Findings: Write a brief executive summary and categorize all extracted entities with bold titles.
+
+    **CRITICAL RULES**:
+    - Do not invent information if the text is nonsensical or empty.
+    - Base your analysis strictly on the provided text.
+    - Do not suggest "further investigation".
+    - If the text seems nonsencial, don't mention it explicitly. Instead mention that the image is too low res to analyse
+    - PAY SPECIAL ATTENTION TO EXTRACTING PERSONAL NAMES AND TITLES when present in the text.
+
+    **Document Text to Analyze**:
+    {text}
+    """
+    prompt = ChatPromptTemplate.from_template(prompt_template)
+    llm = ChatGroq(temperature=0, model_name="llama-3.1-8b-instant", max_tokens=ANALYSIS_MAX_TOKENS)
+    # The raw reply is kept alongside the parsed report to detect truncation
+    structured_llm = llm.with_structured_output(DocumentReport, include_raw=True)
+    return prompt | structured_llm | RunnableLambda(_unpack_report)
+
+
+def _unpack_report(output: Dict) -> Optional[DocumentReport]:
     """
-    Uses a strictly prompted LLM to generate a factual, detailed analysis of the text.
-    (This is the robust function from our previous step).
+    Returns the parsed report of a structured-output reply, or None if it could
+    not be parsed. Raises if generation stopped at ANALYSIS_MAX_TOKENS, since the
+    report is then incomplete.
+    """
+    if output["raw"].response_metadata.get("finish_reason") == "length":
+        raise ValueError(f"The AI report was cut off at the {ANALYSIS_MAX_TOKENS}-token output limit.")
+    return output["parsed"]
+
+
+# Reports are cached on disk by document content; errors are retried next time.
+@disk_cached(version=ANALYSIS_PROMPT_VERSION, cache_if=lambda result: "error" not in result)
+def analyze_document(text_to_analyze: str) -> Dict:
+    """
+    Identifies the client and generates the summary and findings in a single LLM call,
+    so the document text is only sent (and billed) once. The PII sensitivity level is
+    not requested from the LLM; use assess_pii_sensitivity once the PII count is known.
+
+    Returns:
+        A dictionary with "client_name", "executive_summary" and "detailed_findings",
+        or an "error" message.
     """
     if not os.getenv("GROQ_API_KEY"):
         return {"error": "GROQ_API_KEY environment variable not set!"}
     if not text_to_analyze or not text_to_analyze.strip():
-        return {
-            "executive_summary": "No text could be extracted from the document for analysis.",
-            "pii_sensitivity_level": "None",
-            "detailed_findings": {}
-        }
+        return {"client_name": "Unknown", **_EMPTY_ANALYSIS}
 
     try:
-        parser = JsonOutputParser(pydantic_object=IntelligentSummary)
-        prompt_template = """
-        You are a Tier-3 cybersecurity analyst. Your task is to provide a detailed and factual analysis of a document.
-        Follow these steps precisely:
-        1.  Assess PII Risk: Based on the provided PII count ({pii_count}), determine the sensitivity level (None, Low, Medium, High, Critical).
-        2.  Extract Entities: Identify and extract ONLY specific security entities like Firewall Rules, IAM Policies, IP addresses, or hostnames.
-        3.  Generate Summary & Findings: Write a brief executive summary and categorize all extracted entities with bold titles.
-
-        **CRITICAL RULES**:
-        - Do not invent information if the text is nonsensical or empty.
-        - Base your analysis strictly on the provided text.
-        - Do not suggest "further investigation".
-        - If the text seems nonsencial, don't mention it explicitly. Instead mention that the image is too low res to analyse
-        - PAY SPECIAL ATTENTION TO EXTRACTING PERSONAL NAMES AND TITLES when present in the text.
-
-        Respond ONLY with a JSON object in this format: {format_instructions}
-        
-        **Document Text to Analyze**:
-        {text}
-        """
-        prompt = ChatPromptTemplate.from_template(prompt_template)
-        llm = ChatGroq(temperature=0, model_name="llama-3.1-8b-instant")
-        chain = prompt | llm | parser
-
-        return chain.invoke({
-            "text": text_to_analyze,
-            "pii_count": pii_count,
-            "format_instructions": parser.get_format_instructions()
-        })
+        chain = _build_report_chain()
+
+        with _GROQ_SEMAPHORE:
+            report = chain.invoke({"text": text_to_analyze})
+        if report is None:
+            return {"error": "The AI analysis did not return a structured report."}
+
+        result = report.dict()
+        result["client_name"] = _clean_client_name(result.get("client_name") or "")
+        return result
     except Exception as e:
         return {"error": f"An error occurred during AI analysis: {e}"}
 
+
+# --- PII SENSITIVITY (computed locally, no LLM call) ---
+# Highest PII count for each level; anything above the last bound is Critical.
+_PII_LEVEL_BOUNDS = [(0, "None"), (5, "Low"), (20, "Medium"), (50, "High")]
+
+def assess_pii_sensitivity(pii_count: int) -> str:
+    """Maps the number of PII entities found in a document to a sensitivity level."""
+    for upper_bound, level in _PII_LEVEL_BOUNDS:
+        if pii_count <= upper_bound:
+            return level
+    return "Critical"
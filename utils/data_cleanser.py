@@ -1,102 +1,418 @@
-import cv2
-import numpy as np
-from PIL import Image
+import functools
+import multiprocessing
+import os
+import re
+import threading
+import ahocorasick
+import spacy
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import List, Tuple
 
+from utils.pipeline_cache import disk_cached
+
 # --- Presidio Imports for PII Redaction ---
-from presidio_analyzer import AnalyzerEngine, PatternRecognizer, RecognizerResult
-from presidio_anonymizer import AnonymizerEngine
-from presidio_anonymizer.entities import OperatorConfig
+from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine, EntityRecognizer, Pattern, PatternRecognizer, RecognizerResult
+from presidio_analyzer.nlp_engine import SpacyNlpEngine
+
+try:
+    import hyperscan
+except ImportError:  # Not available on every platform (e.g. Windows)
+    hyperscan = None
+
+# --- spaCy configuration ---
+# The small model is a fraction of the size of Presidio's default
+# en_core_web_lg (~600 MB) with similar NER quality for PII entities.
+# PII detection only needs the tokenizer and the NER component, so the
+# remaining pipes are skipped when the model is loaded.
+_SPACY_MODEL = "en_core_web_sm"
+_UNUSED_SPACY_PIPES = ["parser", "tagger", "attribute_ruler", "lemmatizer"]
+
+
+class _NerOnlySpacyNlpEngine(SpacyNlpEngine):
+    """A SpacyNlpEngine that loads its models without the unused pipeline components."""
+
+    def load(self) -> None:
+        for model in self.models:
+            if not spacy.util.is_package(model["model_name"]):
+                spacy.cli.download(model["model_name"])
+        self.nlp = {
+            model["lang_code"]: spacy.load(model["model_name"], disable=_UNUSED_SPACY_PIPES)
+            for model in self.models
+        }
+
 
-def anonymize_text(text_to_clean: str, client_name: str) -> Tuple[str, List[RecognizerResult]]:
+# --- Shared Presidio engine ---
+# Building an AnalyzerEngine loads the spaCy model, so the engine is created
+# once per process and reused by every call.
+_NLP_ENGINE = _NerOnlySpacyNlpEngine(models=[{"lang_code": "en", "model_name": _SPACY_MODEL}])
+_NLP_ENGINE.load()
+_ANALYZER = AnalyzerEngine(nlp_engine=_NLP_ENGINE, supported_languages=["en"])
+
+# --- Custom recognizers ---
+# Patterns Presidio does not cover out of the box. They are compiled and
+# registered once at import, never on the per-document path.
+_JWT_RE = re.compile(r"\beyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+")
+
+# (entity, pattern, score) for the patterns scanned with Hyperscan when it is installed.
+# Emails stay with Presidio's EmailRecognizer, which also checks the domain's TLD
+# (so that e.g. "logo@2x.png" is not redacted).
+_SCAN_PATTERNS = [
+    ("JWT", _JWT_RE, 0.85),
+]
+
+
+class _HyperscanRecognizer(EntityRecognizer):
     """
-    Analyzes text for PII and a custom client name, then redacts them.
+    Matches all of its regexes in one SIMD-accelerated DFA pass using Hyperscan,
+    instead of one backtracking `re` sweep per pattern.
+    """
+
+    def __init__(self, patterns):
+        self._patterns = patterns
+        self._database = hyperscan.Database()
+        self._database.compile(
+            expressions=[pattern.pattern.encode("ascii") for _, pattern, _ in patterns],
+            ids=list(range(len(patterns))),
+            elements=len(patterns),
+            flags=[hyperscan.HS_FLAG_SOM_LEFTMOST] * len(patterns)
+        )
+        # A Hyperscan database's scratch space can only be used by one scan at a time
+        self._scan_lock = threading.Lock()
+        super().__init__(supported_entities=[entity for entity, _, _ in patterns], name="HyperscanRecognizer")
+
+    def load(self) -> None:
+        pass
+
+    def analyze(self, text: str, entities: List[str], nlp_artifacts=None) -> List[RecognizerResult]:
+        # Hyperscan reports every match end; keep the longest match per (pattern, start)
+        longest = {}
+
+        def on_match(pattern_id, start, end, flags, context):
+            if end > longest.get((pattern_id, start), -1):
+                longest[(pattern_id, start)] = end
+
+        # latin-1 with replacement keeps one byte per character, so byte offsets
+        # are also character offsets (all patterns are ASCII-only).
+        data = text.encode("latin-1", errors="replace")
+        with self._scan_lock:
+            self._database.scan(data, match_event_handler=on_match)
+
+        results = []
+        last_end = {}
+        for (pattern_id, start), end in sorted(longest.items()):
+            entity, _, score = self._patterns[pattern_id]
+            # Drop matches nested inside an earlier, leftmost match of the same pattern
+            if entity not in entities or start < last_end.get(pattern_id, 0):
+                continue
+            last_end[pattern_id] = end
+            results.append(RecognizerResult(entity_type=entity, start=start, end=end, score=score))
+        return results
+
+
+if hyperscan is not None:
+    _ANALYZER.registry.add_recognizer(_HyperscanRecognizer(_SCAN_PATTERNS))
+else:
+    _ANALYZER.registry.add_recognizer(PatternRecognizer(
+        supported_entity="JWT",
+        patterns=[Pattern(name="jwt", regex=_JWT_RE.pattern, score=0.85)]
+    ))
+
+_BATCH_ANALYZER = BatchAnalyzerEngine(analyzer_engine=_ANALYZER)
+
+
+# --- Client name matching ---
+# Client names are matched with an Aho-Corasick automaton rather than a Presidio
+# deny-list recognizer: one pass over the text finds every term, however many
+# there are, and the shared analyzer registry never has to be modified.
+@functools.lru_cache(maxsize=128)
+def _get_automaton(terms: Tuple[str, ...]) -> ahocorasick.Automaton:
+    """Builds (once per set of terms) an automaton over the lower-cased terms."""
+    automaton = ahocorasick.Automaton()
+    for term in terms:
+        automaton.add_word(term.lower(), term.lower())
+    automaton.make_automaton()
+    return automaton
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _find_client_names(text: str, terms: Tuple[str, ...]) -> List[RecognizerResult]:
+    """
+    Finds whole-word, case-insensitive occurrences of the client terms in the text.
 
     Args:
-        text_to_clean: The raw text extracted from a document.
-        client_name: The specific client name to find and redact.
+        text: The text to search.
+        terms: The client names to look for.
+
+    Returns:
+        A CLIENT_NAME RecognizerResult for every occurrence.
+    """
+    terms = tuple(term.strip() for term in terms if term and term.strip())
+    if not terms:
+        return []
+
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # A few characters change length when lower-cased; keep those as-is so
+        # offsets still line up with the original text.
+        lowered = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+    results = []
+    for end, term in _get_automaton(terms).iter(lowered):
+        start = end - len(term) + 1
+        # Only accept whole words, like Presidio's deny-list recognizer does.
+        if start > 0 and _is_word_char(lowered[start - 1]):
+            continue
+        if end + 1 < len(lowered) and _is_word_char(lowered[end + 1]):
+            continue
+        results.append(RecognizerResult(entity_type="CLIENT_NAME", start=start, end=end + 1, score=1.0))
+    return results
+
+
+# Bump when the recognizers or spaCy model change, to invalidate cached analyses.
+ANALYSIS_CACHE_VERSION = "3"
+
+@disk_cached(version=ANALYSIS_CACHE_VERSION)
+def _analyze_spans(text_to_analyze: str, client_name: str) -> List[RecognizerResult]:
+    analyzer_results = _ANALYZER.analyze(text=text_to_analyze, language='en')
+    analyzer_results += _find_client_names(text_to_analyze, (client_name,))
+    return analyzer_results
+
+
+def analyze_text(text_to_analyze: str, client_name: str) -> List[RecognizerResult]:
+    """
+    Finds PII and every occurrence of the client name, without redacting anything.
+
+    Args:
+        text_to_analyze: The raw text extracted from a document.
+        client_name: The specific client name to find.
+
+    Returns:
+        The analysis results from Presidio plus the CLIENT_NAME matches.
+        Analysis errors are raised rather than returned as "no PII", since the
+        caller would otherwise pass the text on unredacted.
+    """
+    if not text_to_analyze or not text_to_analyze.strip():
+        return []
+
+    # Cached on disk by content, so re-uploads skip the spaCy pass
+    return _analyze_spans(text_to_analyze, client_name)
+
+
+def find_client_name_spans(text: str, client_name: str) -> List[RecognizerResult]:
+    """
+    Finds every occurrence of the client name, without running the spaCy analysis.
+    Together with analyze_text(text, "") this gives the same spans as
+    analyze_text(text, client_name), for when the client is only known afterwards.
+
+    Args:
+        text: The raw text extracted from a document.
+        client_name: The specific client name to find.
+
+    Returns:
+        A CLIENT_NAME RecognizerResult for every occurrence.
+    """
+    if not text:
+        return []
+    return _find_client_names(text, (client_name,))
+
+
+# Replacement tag per entity type when redacting by spans; everything else is <REDACTED>.
+_SPAN_TAGS = {"CLIENT_NAME": "<CLIENT_NAME_REDACTED>"}
+
+def _redact_spans(text: str, analyzer_results: List[RecognizerResult]) -> Tuple[str, List[RecognizerResult]]:
+    """Redacts the spans, returning the text and the spans of the tags in it."""
+    parts = []
+    tag_spans = []
+    length = 0
+    cursor = 0
+    for result in sorted(analyzer_results, key=lambda r: (r.start, -r.end)):
+        if result.start < cursor:
+            # Overlaps the span just redacted; extend it instead of tagging twice
+            cursor = max(cursor, result.end)
+            continue
+        kept = text[cursor:result.start]
+        tag = _SPAN_TAGS.get(result.entity_type, "<REDACTED>")
+        parts += [kept, tag]
+        length += len(kept)
+        tag_spans.append(RecognizerResult(entity_type=result.entity_type, start=length, end=length + len(tag), score=result.score))
+        length += len(tag)
+        cursor = result.end
+    parts.append(text[cursor:])
+    return "".join(parts), tag_spans
+
+
+def redact_by_spans(text: str, analyzer_results: List[RecognizerResult]) -> str:
+    """
+    Replaces every analyzed span with its tag in a single left-to-right pass.
+    Overlapping spans are merged and tagged after the first one.
+
+    Args:
+        text: The original text the results were computed on.
+        analyzer_results: The spans to redact.
+
+    Returns:
+        The redacted text.
+    """
+    return _redact_spans(text, analyzer_results)[0]
+
+
+# Entities left in the text sent to the LLM: it has to see organization names
+# to identify the client. Everything else is redacted before the text leaves.
+_PROMPT_KEPT_ENTITIES = {"ORGANIZATION"}
+
+def redact_for_prompt(text: str, analyzer_results: List[RecognizerResult]) -> Tuple[str, List[RecognizerResult]]:
+    """
+    Redacts the PII found in a document before it is sent to the LLM.
+
+    Args:
+        text: The original text the results were computed on.
+        analyzer_results: The PII spans found in the text.
 
     Returns:
         A tuple containing:
-        - The cleaned text string.
-        - A list of the analysis results from Presidio (for counting).
-    """
-    # --- Input Validation ---
-    if not text_to_clean or not text_to_clean.strip():
-        return "", []
-    if not client_name or not client_name.strip():
-        # If no client name, still process for other PII
-        analyzer = AnalyzerEngine()
-        analyzer_results = analyzer.analyze(text=text_to_clean, language='en')
-        anonymizer = AnonymizerEngine()
-        anonymized_result = anonymizer.anonymize(
-            text=text_to_clean,
-            analyzer_results=analyzer_results
-        )
-        return anonymized_result.text, analyzer_results
+        - The redacted text, with organization names left in.
+        - The spans of the redaction tags in that text (to choose passages by).
+    """
+    return _redact_spans(text, [r for r in analyzer_results if r.entity_type not in _PROMPT_KEPT_ENTITIES])
+
+
+_TAG_PATTERN = re.compile("|".join(re.escape(tag) for tag in [*_SPAN_TAGS.values(), "<REDACTED>"]))
+
+def find_redaction_tags(text: str) -> List[RecognizerResult]:
+    """
+    Finds the redaction tags in text that was redacted piece by piece (e.g. the
+    cells of a spreadsheet), where redact_for_prompt's tag spans aren't available.
+    """
+    return [
+        RecognizerResult(entity_type="REDACTED", start=match.start(), end=match.end(), score=1.0)
+        for match in _TAG_PATTERN.finditer(text)
+    ]
+
+
+# --- Multi-process analysis ---
+# spaCy inference is CPU-bound and holds the GIL, so threads can't run it in
+# parallel. A long-lived pool of worker processes (each loading the model once
+# at import) takes the analysis of whole documents instead.
+MAX_REDACTION_WORKERS = int(os.getenv("MAX_REDACTION_WORKERS", min(4, os.cpu_count() or 1)))
+_REDACTION_POOL = None
+_REDACTION_POOL_LOCK = threading.Lock()
+
 
+def _analyze_worker(args: Tuple[str, str]) -> List[RecognizerResult]:
+    """Runs analyze_text in a worker process. Module-level so it can be pickled."""
+    text_to_analyze, client_name = args
+    return analyze_text(text_to_analyze, client_name)
+
+
+def _get_redaction_pool() -> ProcessPoolExecutor:
+    global _REDACTION_POOL
+    with _REDACTION_POOL_LOCK:
+        if _REDACTION_POOL is None:
+            _REDACTION_POOL = ProcessPoolExecutor(
+                max_workers=MAX_REDACTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _REDACTION_POOL
+
+
+def analyze_text_in_process(text_to_analyze: str, client_name: str) -> List[RecognizerResult]:
+    """
+    Same as analyze_text, but runs in the shared worker-process pool so that
+    several documents can be analyzed on separate cores at once.
+    Falls back to the current process if a worker dies; analysis errors are raised.
+    """
+    global _REDACTION_POOL
+    pool = _get_redaction_pool()
     try:
-        # 1. Create a custom recognizer for the specific client name.
-        client_name_recognizer = PatternRecognizer(
-            supported_entity="CLIENT_NAME", 
-            deny_list=[client_name]
-        )
-        
-        # 2. Set up the Presidio AnalyzerEngine.
-        analyzer = AnalyzerEngine()
-        analyzer.registry.add_recognizer(client_name_recognizer)
-
-        # 3. Ask the analyzer to find all PII and the custom client name.
-        analyzer_results = analyzer.analyze(text=text_to_clean, language='en')
-
-        # 4. Set up the AnonymizerEngine.
-        anonymizer = AnonymizerEngine()
-        
-        # 5. Anonymize the text.
-        anonymized_result = anonymizer.anonymize(
-            text=text_to_clean,
-            analyzer_results=analyzer_results,
-            operators={
-                "DEFAULT": OperatorConfig("replace", {"new_value": "<REDACTED>"}),
-                "CLIENT_NAME": OperatorConfig("replace", {"new_value": "<CLIENT_NAME_REDACTED>"})
-            }
-        )
-        
-        # 6. Return both the cleaned text and the list of results.
-        return anonymized_result.text, analyzer_results
-    
+        return pool.submit(_analyze_worker, (text_to_analyze, client_name)).result()
+    except BrokenProcessPool as e:
+        print(f"[ERROR] Analysis worker pool failed, analyzing in-process: {e}")
+        # A broken pool rejects every later task, so drop it and let the next call start a new one
+        with _REDACTION_POOL_LOCK:
+            if _REDACTION_POOL is pool:
+                _REDACTION_POOL = None
+        pool.shutdown(wait=False)
+        return analyze_text(text_to_analyze, client_name)
+
+
+def anonymize_texts(texts: List[str], client_name: str, batch_size: int = 64) -> List[str]:
+    """
+    Redacts PII and the client name from many texts (e.g. spreadsheet cells) at once.
+    The texts are fed through spaCy in batches instead of one analyze() call each.
+
+    Args:
+        texts: The strings to redact.
+        client_name: The specific client name to find and redact.
+        batch_size: Number of texts processed per spaCy batch.
+
+    Returns:
+        The redacted strings, in the same order as the input.
+    """
+    if not texts:
+        return []
+
+    try:
+        return [text for text, _ in _anonymize_batch(texts, client_name, batch_size)]
+
     except Exception as e:
         error_message = f"An error occurred during text anonymization: {e}"
         print(error_message)
-        return error_message, []
+        return [error_message] * len(texts)
 
 
-def detect_logo(document_image_path: str, logo_image_path: str) -> bool:
+def anonymize_dataframe(df: pd.DataFrame, client_name: str, for_prompt: bool = False) -> Tuple[pd.DataFrame, int]:
     """
-    Detect if the logo exists in the document image using template matching.
+    Redacts PII and the client name from every cell and column label of a DataFrame.
+    Each distinct value is analyzed once and the result mapped back onto
+    all of its occurrences, so repeated values (IDs, cities, names) cost nothing extra.
 
     Args:
-        document_image_path (str): Path to the main document image.
-        logo_image_path (str): Path to the logo image.
+        df: The table to redact.
+        client_name: The specific client name to find and redact.
+        for_prompt: Leave organization names in, as redact_for_prompt does,
+            so that the table can be sent to the LLM to identify the client.
 
     Returns:
-        bool: True if logo is found, False otherwise.
+        A tuple containing:
+        - A redacted copy of the table, with every non-empty cell as a string.
+        - The number of PII entities found across all cells (for counting).
+        Analysis errors are raised, so an unredacted table is never passed on.
     """
-    try:
-        doc_img = cv2.imread(document_image_path, cv2.IMREAD_COLOR)
-        logo_img = cv2.imread(logo_image_path, cv2.IMREAD_COLOR)
+    cells = df.astype(str).where(df.notna())
+    labels = [str(label) for label in df.columns]
+    unique_values = list(dict.fromkeys(labels + [v for v in pd.unique(cells.values.ravel()) if isinstance(v, str)]))
 
-        if doc_img is None or logo_img is None:
-            print("[ERROR] Could not load images. Check the paths.")
-            return False
+    kept_entities = _PROMPT_KEPT_ENTITIES if for_prompt else ()
+    redacted_map = {}
+    entity_counts = {}
+    for value, (text, results) in zip(unique_values, _anonymize_batch(unique_values, client_name, kept_entities=kept_entities)):
+        redacted_map[value] = text
+        entity_counts[value] = len(results)
 
-        res = cv2.matchTemplate(doc_img, logo_img, cv2.TM_CCOEFF_NORMED)
-        threshold = 0.8
-        loc = (res >= threshold).any()
-        return loc
+    redacted = cells.apply(lambda col: col.map(redacted_map))
+    redacted.columns = [redacted_map[label] for label in labels]
+    pii_count = int(cells.stack().map(entity_counts).sum())
+    return redacted, pii_count
 
-    except Exception as e:
-        print(f"[ERROR] Logo detection failed: {e}")
-        return False
-    pass
 
+def _anonymize_batch(texts: List[str], client_name: str, batch_size: int = 64, kept_entities=()) -> List[Tuple[str, List[RecognizerResult]]]:
+    """
+    Runs batched analysis and anonymization, returning (redacted text, results) per input.
+    Entities in kept_entities are counted in the results but left in the text.
+    """
+    all_results = list(_BATCH_ANALYZER.analyze_iterator(
+        texts=texts, language='en', batch_size=batch_size
+    ))
+    for text, results in zip(texts, all_results):
+        results.extend(_find_client_names(text, (client_name,)))
+
+    redacted_texts = []
+    for text, results in zip(texts, all_results):
+        redacted_spans = [r for r in results if r.entity_type not in kept_entities]
+        redacted_texts.append(redact_by_spans(text, redacted_spans) if redacted_spans else text)
+    return list(zip(redacted_texts, all_results))
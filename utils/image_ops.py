@@ -0,0 +1,240 @@
+import functools
+import os
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Logo detection and redaction. Kept apart from data_cleanser so that image
+# work does not have to import (and load the models of) the text PII stack.
+
+# --- Template matching ---
+def _cuda_available() -> bool:
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def _opencl_available() -> bool:
+    try:
+        return cv2.ocl.haveOpenCL()
+    except (AttributeError, cv2.error):
+        return False
+
+
+# Use OpenCV's CUDA template matcher when an NVIDIA GPU is available, and its
+# OpenCL (transparent API) backend for any other GPU.
+HAS_CUDA = _cuda_available()
+HAS_OPENCL = not HAS_CUDA and _opencl_available()
+if HAS_OPENCL:
+    cv2.ocl.setUseOpenCL(True)
+
+# Below this many image pixels (e.g. the small full-resolution confirmation
+# windows) the upload to the OpenCL device costs more than it saves.
+OPENCL_MIN_PIXELS = 256 * 256
+
+
+def _match_template(image_gray: np.ndarray, logo_gray: np.ndarray) -> np.ndarray:
+    """
+    Runs TM_CCOEFF_NORMED template matching on two single-channel uint8 images,
+    on the GPU when CUDA or OpenCL is available and on the CPU otherwise.
+    """
+    if HAS_CUDA:
+        gpu_image = cv2.cuda_GpuMat()
+        gpu_image.upload(image_gray)
+        gpu_logo = cv2.cuda_GpuMat()
+        gpu_logo.upload(logo_gray)
+        # The CUDA matcher only supports TM_CCOEFF_NORMED on 8-bit input
+        matcher = cv2.cuda.createTemplateMatching(cv2.CV_8U, cv2.TM_CCOEFF_NORMED)
+        return matcher.match(gpu_image, gpu_logo).download()
+
+    if HAS_OPENCL and image_gray.size >= OPENCL_MIN_PIXELS:
+        # Wrapping the inputs in UMats dispatches matchTemplate to the OpenCL kernel
+        return cv2.matchTemplate(cv2.UMat(image_gray), cv2.UMat(logo_gray), cv2.TM_CCOEFF_NORMED).get()
+
+    return cv2.matchTemplate(
+        image_gray.astype(np.float32), logo_gray.astype(np.float32), cv2.TM_CCOEFF_NORMED
+    )
+
+
+# Large logos are first searched for on a Gaussian pyramid of the document and
+# logo. Each level halves both images, cutting the matchTemplate work ~16x, and
+# documents without the logo are rejected there; hits are confirmed at full size.
+MAX_PYRAMID_LEVELS = 2
+# Levels are only added while the logo keeps at least this many pixels per side.
+MIN_SCALED_LOGO_SIDE = 16
+# Downscaling blurs fine logo detail (more so per level), so coarse candidates
+# are accepted at this much below the threshold...
+COARSE_THRESHOLD_SLACK = {1: 0.3, 2: 0.4}
+# ...and re-matched at full resolution within this many pixels per level.
+REFINE_MARGIN_PER_LEVEL = 4
+
+
+def _pyr_down(image: np.ndarray, levels: int) -> np.ndarray:
+    for _ in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
+
+# --- Logo loading ---
+@functools.lru_cache(maxsize=32)
+def _load_logo_cached(logo_image_path: str, mtime_ns: int) -> Tuple[Optional[np.ndarray], Tuple[np.ndarray, ...]]:
+    gray = cv2.imread(logo_image_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None, ()
+
+    pyramid = []
+    level = gray
+    while len(pyramid) < MAX_PYRAMID_LEVELS and min(level.shape[:2]) >= 2 * MIN_SCALED_LOGO_SIDE:
+        level = cv2.pyrDown(level)
+        pyramid.append(level)
+
+    # The arrays are shared by every caller; make sure none of them edits one in place.
+    for image in [gray] + pyramid:
+        image.setflags(write=False)
+    return gray, tuple(pyramid)
+
+
+def _load_logo(logo_image_path: str) -> Tuple[Optional[np.ndarray], Tuple[np.ndarray, ...]]:
+    """
+    Loads a logo as (grayscale, pyramid), decoding each file only once across a
+    batch of documents. The pyramid holds the half- and quarter-resolution copies,
+    as far as the logo is large enough for them; the image is None if the file
+    can't be read. The cache is keyed on the file's modification time, so edited
+    logos are reloaded.
+    """
+    try:
+        mtime_ns = os.stat(logo_image_path).st_mtime_ns
+    except OSError:
+        return None, ()
+    return _load_logo_cached(logo_image_path, mtime_ns)
+
+
+def _match_mask(doc_gray: np.ndarray, logo_gray: np.ndarray, logo_pyramid: Tuple[np.ndarray, ...],
+                threshold: float) -> np.ndarray:
+    """
+    Finds every position where the logo matches the document.
+
+    Args:
+        doc_gray (np.ndarray): Grayscale document image.
+        logo_gray (np.ndarray): Grayscale logo image, no larger than the document.
+        logo_pyramid (tuple): The logo's downscaled copies as _load_logo returns
+            them; when empty, the logo is matched at full resolution only.
+        threshold (float): Minimum full-resolution match score.
+
+    Returns:
+        np.ndarray: uint8 map with one entry per top-left logo position, set to 1
+        where the logo matches.
+    """
+    h, w = logo_gray.shape[:2]
+    if not logo_pyramid:
+        return (_match_template(doc_gray, logo_gray) >= threshold).astype(np.uint8)
+
+    levels = len(logo_pyramid)
+    scale = 2 ** levels
+    margin = REFINE_MARGIN_PER_LEVEL * levels
+    coarse_logo = logo_pyramid[-1]
+    sh, sw = coarse_logo.shape[:2]
+    coarse = _match_template(_pyr_down(doc_gray, levels), coarse_logo)
+    mask = np.zeros((doc_gray.shape[0] - h + 1, doc_gray.shape[1] - w + 1), np.uint8)
+
+    # Non-maximum suppression: take the best remaining candidate, blank out its
+    # neighbourhood, and confirm it at full resolution in a small window.
+    while True:
+        _, score, _, (x, y) = cv2.minMaxLoc(coarse)
+        if score < threshold - COARSE_THRESHOLD_SLACK[levels]:
+            break
+        coarse[max(0, y - sh // 2):y + sh // 2 + 1, max(0, x - sw // 2):x + sw // 2 + 1] = -1
+
+        fx, fy = x * scale, y * scale
+        x0, y0 = max(0, fx - margin), max(0, fy - margin)
+        x1 = min(mask.shape[1], fx + margin + 1)
+        y1 = min(mask.shape[0], fy + margin + 1)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        res = _match_template(doc_gray[y0:y1 + h - 1, x0:x1 + w - 1], logo_gray)
+        mask[y0:y1, x0:x1] |= (res >= threshold).astype(np.uint8)
+
+    return mask
+
+
+def detect_logo(document_image_path: str, logo_image_path: str) -> bool:
+    """
+    Detect if the logo exists in the document image using template matching.
+
+    Args:
+        document_image_path (str): Path to the main document image.
+        logo_image_path (str): Path to the logo image.
+
+    Returns:
+        bool: True if logo is found, False otherwise.
+    """
+    try:
+        # The logo comes from the cache; without one, don't decode the document at all.
+        logo_img, logo_pyramid = _load_logo(logo_image_path)
+        if logo_img is None:
+            print("[ERROR] Could not load images. Check the paths.")
+            return False
+
+        # Match on single-channel float32 images: a third of the work of BGR matching.
+        doc_img = cv2.imread(document_image_path, cv2.IMREAD_GRAYSCALE)
+        if doc_img is None:
+            print("[ERROR] Could not load images. Check the paths.")
+            return False
+
+        # A logo larger than the document can never match.
+        if logo_img.shape[0] > doc_img.shape[0] or logo_img.shape[1] > doc_img.shape[1]:
+            return False
+
+        threshold = 0.8
+        return bool(_match_mask(doc_img, logo_img, logo_pyramid, threshold).any())
+
+    except Exception as e:
+        print(f"[ERROR] Logo detection failed: {e}")
+        return False
+
+
+def redact_logo(document_image_path: str, logo_image_path: str, threshold: float = 0.8) -> Optional[np.ndarray]:
+    """
+    Black out every occurrence of the logo in the document image.
+
+    Args:
+        document_image_path (str): Path to the main document image.
+        logo_image_path (str): Path to the logo image.
+        threshold (float): Minimum match score for a location to be redacted.
+
+    Returns:
+        np.ndarray: The redacted BGR image, or None if it could not be processed.
+    """
+    try:
+        logo_img, logo_pyramid = _load_logo(logo_image_path)
+        if logo_img is None:
+            print("[ERROR] Could not load images. Check the paths.")
+            return None
+
+        doc_img = cv2.imread(document_image_path, cv2.IMREAD_COLOR)
+        if doc_img is None:
+            print("[ERROR] Could not load images. Check the paths.")
+            return None
+
+        # A logo larger than the document can never match: skip the grayscale conversion.
+        h, w = logo_img.shape[:2]
+        if h > doc_img.shape[0] or w > doc_img.shape[1]:
+            return doc_img
+
+        doc_gray = cv2.cvtColor(doc_img, cv2.COLOR_BGR2GRAY)
+
+        # Each match marks the top-left corner of a logo-sized box. Pad the match map
+        # back to the document size and dilate it so every box is covered in one pass.
+        mask = _match_mask(doc_gray, logo_img, logo_pyramid, threshold)
+        mask = cv2.copyMakeBorder(mask, 0, h - 1, 0, w - 1, cv2.BORDER_CONSTANT, value=0)
+        covered = cv2.dilate(mask, np.ones((h, w), np.uint8), anchor=(w - 1, h - 1))
+
+        doc_img[covered.astype(bool)] = 0
+        return doc_img
+
+    except Exception as e:
+        print(f"[ERROR] Logo redaction failed: {e}")
+        return None
+
@@ -0,0 +1,52 @@
+import functools
+import hashlib
+from typing import Any, Callable, Optional
+
+import diskcache
+
+# --- Persistent pipeline cache ---
+# Results of the expensive pipeline stages (spaCy analysis, Groq calls) are kept
+# on disk, so repeated uploads and Streamlit reruns (or app restarts) skip them.
+PIPELINE_CACHE_DIR = ".cache/pipeline"
+PIPELINE_CACHE_SIZE_LIMIT = 256 * 1024 * 1024
+_PIPELINE_CACHE = diskcache.Cache(PIPELINE_CACHE_DIR, size_limit=PIPELINE_CACHE_SIZE_LIMIT)
+
+
+def _cache_key(func: Callable, version: str, args: tuple) -> str:
+    """Hashes the function, its version and its arguments into a cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{func.__module__}.{func.__qualname__}:{version}".encode("utf-8"))
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode("utf-8")
+        else:
+            data = repr(arg).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def disk_cached(version: str, cache_if: Optional[Callable[[Any], bool]] = None):
+    """
+    Memoizes a function on disk, keyed on a hash of its positional arguments.
+
+    Args:
+        version: Bump this when the function's output changes (e.g. a prompt edit)
+            to invalidate its old entries.
+        cache_if: Optional predicate; results for which it returns False
+            (such as error responses) are returned but not stored.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = _cache_key(func, version, args)
+            result = _PIPELINE_CACHE.get(key)
+            if result is None:
+                result = func(*args)
+                if cache_if is None or cache_if(result):
+                    _PIPELINE_CACHE.set(key, result)
+            return result
+        return wrapper
+    return decorator
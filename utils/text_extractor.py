@@ -1,36 +1,287 @@
+import hashlib
 import os
-from PIL import Image
+
+# Tesseract's internal OpenMP threading scales poorly; pin each OCR call to one
+# core and parallelize across pages instead. Must be set before tesserocr loads.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import mmap
+import shutil
+import tempfile
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 import pytesseract
-import fitz  # PyMuPDF
-from pptx import Presentation
-import pandas as pd
 import cv2 # OpenCV for image processing
 import numpy as np
 import streamlit as st
+import diskcache
+
+# The per-format libraries (PyMuPDF, python-pptx, pandas) are imported in the
+# branches of extract_text that need them, so the app's cold start doesn't pay
+# for parsers a given upload never touches.
+if TYPE_CHECKING:
+    import fitz  # PyMuPDF
+
+try:
+    import tesserocr
+except ImportError:  # Falls back to the pytesseract CLI wrapper
+    tesserocr = None
+
+# The tesseract executable (used when tesserocr is not installed): TESSERACT_CMD if
+# set, else the one on the PATH, else the default Windows install location.
+_WINDOWS_TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+_tesseract_cmd = os.getenv("TESSERACT_CMD") or shutil.which("tesseract")
+if not _tesseract_cmd and os.path.exists(_WINDOWS_TESSERACT_CMD):
+    _tesseract_cmd = _WINDOWS_TESSERACT_CMD
+if _tesseract_cmd:
+    pytesseract.pytesseract.tesseract_cmd = _tesseract_cmd
+    # Point Tesseract straight at the tessdata folder of a self-contained install
+    # (the Windows layout), so it doesn't probe its search paths on every run.
+    _tessdata_dir = os.path.join(os.path.dirname(_tesseract_cmd), "tessdata")
+    if os.path.isdir(_tessdata_dir):
+        os.environ.setdefault("TESSDATA_PREFIX", _tessdata_dir)
+
+# --- OCR engine ---
+# pytesseract starts a new tesseract process (and reloads the language data) for
+# every image. With tesserocr installed, each thread instead keeps its own
+# resident PyTessBaseAPI (a single API instance is not thread-safe).
+_TESS_APIS = threading.local()
+
+def _get_tess_api(uniform_block: bool):
+    apis = getattr(_TESS_APIS, "apis", None)
+    if apis is None:
+        apis = _TESS_APIS.apis = {}
+    if uniform_block not in apis:
+        if uniform_block:
+            apis[uniform_block] = tesserocr.PyTessBaseAPI(
+                lang="eng", psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.LSTM_ONLY
+            )
+        else:
+            apis[uniform_block] = tesserocr.PyTessBaseAPI(lang="eng", psm=tesserocr.PSM.AUTO)
+    return apis[uniform_block]
+
+
+def run_ocr(image: np.ndarray, uniform_block: bool = False) -> str:
+    """
+    OCRs a (pre-processed) image.
+
+    Args:
+        image: The grayscale image to read.
+        uniform_block: Treat the image as a single uniform block of text using the
+            LSTM engine (--oem 1 --psm 6), as for rendered PDF pages.
+    """
+    if tesserocr is None:
+        config = PDF_OCR_CONFIG if uniform_block else ""
+        return pytesseract.image_to_string(image, config=config)
+
+    api = _get_tess_api(uniform_block)
+    # Hand tesserocr the raw pixels directly, without building a PIL image
+    image = np.ascontiguousarray(image)
+    h, w = image.shape
+    api.SetImageBytes(image.tobytes(), w, h, 1, w)
+    return api.GetUTF8Text()
+
+# --- Deskewing ---
+# Skew below this is left alone; above the maximum the estimate is more likely
+# thrown off by a figure or a page border than caused by a tilted scan.
+MIN_DESKEW_ANGLE = 0.5
+MAX_DESKEW_ANGLE = 15.0
+
+def _deskew(binary: np.ndarray) -> np.ndarray:
+    """
+    Rotates a thresholded (dark text on white) image so its text lines are level.
+    The skew angle is taken from the minimum-area rectangle around the text pixels.
+    """
+    text_pixels = cv2.findNonZero(cv2.bitwise_not(binary))
+    if text_pixels is None:
+        return binary
+
+    # minAreaRect's angle convention differs between OpenCV versions; fold it into [-45, 45)
+    angle = (cv2.minAreaRect(text_pixels)[-1] + 45) % 90 - 45
+    if not MIN_DESKEW_ANGLE <= abs(angle) <= MAX_DESKEW_ANGLE:
+        return binary
+
+    h, w = binary.shape
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(
+        binary, rotation, (w, h), flags=cv2.INTER_NEAREST,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=255
+    )
 
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+# Longest side, in pixels, of images handed to Tesseract. Past ~300 DPI on a
+# page (~2400 px) accuracy plateaus while OCR time keeps growing with pixel count.
+OCR_MAX_SIDE = 2400
+
+# Adaptive thresholding: each pixel is compared with a Gaussian-weighted mean of a
+# neighborhood about 1/30 of the image's shorter side (odd, at least this many
+# pixels), minus ADAPTIVE_THRESHOLD_C.
+ADAPTIVE_MIN_BLOCK_SIZE = 31
+ADAPTIVE_THRESHOLD_C = 10
 
 # --- NEW: Image Pre-processing Function ---
-def preprocess_image_for_ocr(image: Image.Image) -> Image.Image:
-    """Applies several pre-processing techniques to an image to improve OCR accuracy."""
-    # Convert the Pillow image to an OpenCV-compatible format (NumPy array)
-    img_cv = np.array(image.convert('RGB'))
-    
-    # 1. Convert to grayscale, as color information is not needed for OCR
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_RGB2GRAY)
-    
+def preprocess_image_for_ocr(gray: np.ndarray) -> np.ndarray:
+    """
+    Applies several pre-processing techniques to an image to improve OCR accuracy.
+    Takes and returns a single-channel NumPy array: images are decoded (or PDF
+    pages rendered) straight to grayscale, so no PIL or color conversions are needed.
+    """
+    # 1. Downscale oversized scans (e.g. 12 MP phone photos) to OCR_MAX_SIDE. Done
+    #    first, on the grayscale image, so every later step also works on fewer pixels.
+    h, w = gray.shape
+    downscaled = max(h, w) > OCR_MAX_SIDE
+    if downscaled:
+        scale = OCR_MAX_SIDE / max(h, w)
+        gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
     # 2. Apply a threshold to create a binary (black and white) image.
     # This is the most critical step for separating text from the background.
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # A local (adaptive) threshold copes with shadows and uneven lighting on
+    # photographed pages, where a single global (Otsu) cutoff blacks out whole regions.
+    block_size = max(ADAPTIVE_MIN_BLOCK_SIZE, min(gray.shape) // 30 | 1)
+    thresh = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+        block_size, ADAPTIVE_THRESHOLD_C
+    )
+
+    # 3. Straighten skewed scans; Tesseract is slower and less accurate on tilted lines.
+    thresh = _deskew(thresh)
     
-    # 3. (Optional but helpful) Upscale the image if it's small. Tesseract works
+    # 4. (Optional but helpful) Upscale the image if it's small. Tesseract works
     #    best on images with a DPI of at least 300, so larger text is better.
     h, w = thresh.shape
-    if h < 500 or w < 500: # Heuristic for small images
+    if not downscaled and (h < 500 or w < 500): # Heuristic for small images
         thresh = cv2.resize(thresh, (w*2, h*2), interpolation=cv2.INTER_CUBIC)
-        
-    # Convert the processed OpenCV image back to a Pillow image for pytesseract
-    return Image.fromarray(thresh)
+
+    return thresh
+
+
+# --- PDF OCR fallback for pages without a text layer ---
+# 1.5x zoom (~108 DPI) is plenty for Tesseract on rendered PDF pages.
+PDF_OCR_ZOOM = 1.5
+# LSTM engine, assuming a single uniform block of text per page.
+PDF_OCR_CONFIG = "--oem 1 --psm 6"
+# Pages whose text layer has fewer characters than this (e.g. only a stamped page
+# number on a scan) are treated as scanned and OCRed.
+PDF_MIN_TEXT_CHARS = 20
+# Upper bound on images OCRed at the same time, across all files being processed.
+MAX_OCR_WORKERS = int(os.getenv("MAX_OCR_WORKERS", os.cpu_count() or 1))
+# Most images handed to one tesseract process through a list-of-files manifest;
+# very long lists have been reported to hang it.
+MAX_OCR_BATCH_SIZE = 32
+# All OCR runs on this long-lived pool, shared by every file being processed, so
+# the per-thread tesserocr APIs (and their loaded language data) are reused
+# across documents instead of dying with a per-document pool.
+_OCR_POOL = ThreadPoolExecutor(max_workers=MAX_OCR_WORKERS, thread_name_prefix="ocr")
+
+def _render_page(page: "fitz.Page") -> np.ndarray:
+    """Renders a PDF page to a grayscale image for OCR."""
+    import fitz  # PyMuPDF
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(PDF_OCR_ZOOM, PDF_OCR_ZOOM), colorspace=fitz.csGRAY)
+    return np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def _ocr_page_image(image: np.ndarray) -> str:
+    """OCRs one rendered PDF page."""
+    processed_image = preprocess_image_for_ocr(image)
+    return run_ocr(processed_image, uniform_block=True)
+
+
+def _ocr_image_batch(images: list, uniform_block: bool = False) -> list:
+    """
+    OCRs several pre-processed images with a single tesseract process, through a
+    list-of-files manifest, instead of starting tesseract (and reloading its
+    language data) once per image. Used when tesserocr is not installed.
+
+    Returns:
+        The text of each image, in input order.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, image in enumerate(images):
+            path = os.path.join(tmp_dir, f"{i}.png")
+            cv2.imwrite(path, image)
+            paths.append(path)
+        manifest = os.path.join(tmp_dir, "list.txt")
+        with open(manifest, "w", encoding="utf-8") as f:
+            f.write("\n".join(paths) + "\n")
+
+        config = PDF_OCR_CONFIG if uniform_block else ""
+        output = pytesseract.image_to_string(manifest, config=config)
+
+    # Tesseract ends the text of every image with a form feed
+    texts = output.split("\x0c")[:len(images)]
+    return texts + [""] * (len(images) - len(texts))
+
+
+def _ocr_page_batch(images: list) -> list:
+    """OCRs a group of rendered PDF pages with one tesseract process."""
+    return _ocr_image_batch([preprocess_image_for_ocr(image) for image in images], uniform_block=True)
+
+
+def _ocr_page_images(images: list) -> list:
+    """OCRs rendered pages across the OCR thread pool, returning the text in page order."""
+    # Both OCR backends release the GIL (tesserocr in C, pytesseract while waiting
+    # on the tesseract process), so threads scale without pickling page images.
+    if tesserocr is not None or len(images) == 1:
+        return list(_OCR_POOL.map(_ocr_page_image, images))
+
+    # pytesseract starts a process per call, so each worker OCRs its share of
+    # the pages in as few tesseract runs as the batch size allows.
+    workers = min(MAX_OCR_WORKERS, len(images))
+    batch_size = min(MAX_OCR_BATCH_SIZE, -(-len(images) // workers))
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+    return [text for batch in _OCR_POOL.map(_ocr_page_batch, batches) for text in batch]
+
+
+# --- PDF loading ---
+@contextmanager
+def _open_pdf(uploaded_file):
+    """
+    Opens an uploaded PDF with PyMuPDF without copying its bytes.
+
+    In-memory uploads (Streamlit's UploadedFile is a BytesIO) hand over their bytes
+    object; files on disk are memory-mapped.
+    """
+    import fitz  # PyMuPDF
+
+    if hasattr(uploaded_file, "getvalue"):
+        # A BytesIO created from bytes returns that same object here, while
+        # getbuffer() would first copy it into a private, writable buffer.
+        data = uploaded_file.getvalue()
+    elif hasattr(uploaded_file, "fileno"):
+        data = memoryview(mmap.mmap(uploaded_file.fileno(), 0, access=mmap.ACCESS_READ))
+    else:
+        data = uploaded_file.read()
+
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        yield doc
+    finally:
+        # Close explicitly so the bytes (or mapping) are released right away
+        doc.close()
+        if isinstance(data, memoryview):
+            source = data.obj
+            data.release()
+            source.close()
+
+
+def sheets_to_text(sheets: dict) -> str:
+    """
+    Renders a {sheet name: DataFrame} mapping as plain text, one block per sheet.
+    Rows are tab-separated rather than padded into aligned columns (to_string),
+    which is an order of magnitude faster and sends far fewer tokens to the LLM.
+    """
+    parts = []
+    for sheet_name, df in sheets.items():
+        parts.append(f"--- Sheet: {sheet_name} ---\n")
+        parts.append(df.to_csv(sep="\t", index=False))
+        parts.append("\n")
+    return "".join(parts)
 
 
 # --- Updated Extraction Function ---
@@ -44,29 +295,46 @@ def extract_text(uploaded_file: st.runtime.uploaded_file_manager.UploadedFile) -
         
         # --- THIS IS THE UPGRADED PART ---
         if file_extension in ['.jpg', '.jpeg', '.png']:
-            image = Image.open(uploaded_file)
+            # Decode straight to grayscale: OCR needs no color, and this skips the PIL
+            # image and the RGB copy the pre-processing used to start from
+            image = cv2.imdecode(np.frombuffer(uploaded_file.getvalue(), np.uint8), cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                return {"text": None, "error": f"Could not decode the image {uploaded_file.name}"}
             # Add the new pre-processing step before performing OCR
             processed_image = preprocess_image_for_ocr(image)
-            text = pytesseract.image_to_string(processed_image)
+            # On the OCR pool, whose threads keep their Tesseract API between files
+            text = _OCR_POOL.submit(run_ocr, processed_image).result()
             return {"text": text, "error": None}
 
         # --- (Rest of the file types remain the same) ---
         elif file_extension == '.pdf':
-            text = ""
-            with fitz.open(stream=uploaded_file.read(), filetype="pdf") as doc:
-                for page in doc:
-                    text += page.get_text()
-            return {"text": text, "error": None}
+            parts = []
+            scanned_pages = {}  # page index -> rendered page image
+            with _open_pdf(uploaded_file) as doc:
+                for page_num, page in enumerate(doc):
+                    page_text = page.get_text("text")
+                    # Only fall back to OCR for scanned pages: (almost) no text layer, but raster images
+                    if len(page_text.strip()) < PDF_MIN_TEXT_CHARS and page.get_images(full=False):
+                        scanned_pages[page_num] = _render_page(page)
+                    parts.append(page_text)
+
+            if scanned_pages:
+                ocr_texts = _ocr_page_images(list(scanned_pages.values()))
+                for page_num, page_text in zip(scanned_pages, ocr_texts):
+                    parts[page_num] = page_text
+            return {"text": "".join(parts), "error": None}
 
         elif file_extension == '.pptx':
-            text = ""
+            from pptx import Presentation
+
+            parts = []
             prs = Presentation(uploaded_file)
             for slide_num, slide in enumerate(prs.slides, 1):
                 # Extract text from all shapes
                 for shape in slide.shapes:
                     # Extract text from text frames
                     if hasattr(shape, "text") and shape.text:
-                        text += shape.text + "\n"
+                        parts.append(shape.text + "\n")
                     
                     # Extract text from tables
                     if shape.has_table:
@@ -77,24 +345,24 @@ def extract_text(uploaded_file: st.runtime.uploaded_file_manager.UploadedFile) -
                                 if cell.text:
                                     row_text.append(cell.text)
                             if row_text:
-                                text += " | ".join(row_text) + "\n"
+                                parts.append(" | ".join(row_text) + "\n")
                     
                     # Extract text from grouped shapes
                     if hasattr(shape, "shapes"):
                         for sub_shape in shape.shapes:
                             if hasattr(sub_shape, "text") and sub_shape.text:
-                                text += sub_shape.text + "\n"
+                                parts.append(sub_shape.text + "\n")
                 
-                text += "\n"  # Add spacing between slides
+                parts.append("\n")  # Add spacing between slides
             
-            return {"text": text, "error": None}
+            return {"text": "".join(parts), "error": None}
 
         elif file_extension == '.xlsx':
-            text = ""
-            excel_sheets = pd.read_excel(uploaded_file, sheet_name=None)
-            for sheet_name, df in excel_sheets.items():
-                text += f"--- Sheet: {sheet_name} ---\n{df.to_string()}\n\n"
-            return {"text": text, "error": None}
+            import pandas as pd
+
+            excel_sheets = pd.read_excel(uploaded_file, sheet_name=None, engine="calamine")
+            # The parsed sheets are returned too, so they can be redacted cell by cell
+            return {"text": sheets_to_text(excel_sheets), "error": None, "sheets": excel_sheets}
             
         else:
             return {"text": None, "error": f"Unsupported file format: {file_extension}"}
@@ -102,3 +370,53 @@ def extract_text(uploaded_file: st.runtime.uploaded_file_manager.UploadedFile) -
     except Exception as e:
         return {"text": None, "error": f"An error occurred while processing {uploaded_file.name}: {e}"}
 
+
+# --- Extraction cache ---
+# Re-uploads of the same file skip OCR/parsing entirely. Results are kept on
+# disk, keyed on a hash of the file's bytes, and evicted past the size limit.
+# The entries hold the unredacted text, so the cache is off unless
+# EXTRACT_CACHE_TTL (seconds to keep each entry) is set.
+EXTRACT_CACHE_DIR = ".extract_cache"
+# Bump when the extracted text changes (OCR pre-processing, page or sheet layout),
+# so entries extracted by an older version are not served again.
+EXTRACT_CACHE_VERSION = "2"
+EXTRACT_CACHE_SIZE_LIMIT = 512 * 1024 * 1024
+EXTRACT_CACHE_TTL = int(os.getenv("EXTRACT_CACHE_TTL", 0))
+_EXTRACT_CACHE = diskcache.Cache(EXTRACT_CACHE_DIR, size_limit=EXTRACT_CACHE_SIZE_LIMIT) if EXTRACT_CACHE_TTL > 0 else None
+
+def extract_text_cached(uploaded_file: st.runtime.uploaded_file_manager.UploadedFile) -> dict:
+    """
+    Same as extract_text, but memoized on disk by the file's contents when
+    EXTRACT_CACHE_TTL is set. Failed extractions are not cached.
+    """
+    if _EXTRACT_CACHE is None:
+        return extract_text(uploaded_file)
+
+    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+    file_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    key = f"{EXTRACT_CACHE_VERSION}:{file_extension}:{file_hash}"
+
+    result = _EXTRACT_CACHE.get(key)
+    if result is None:
+        result = extract_text(uploaded_file)
+        if not result.get("error"):
+            _EXTRACT_CACHE.set(key, result, expire=EXTRACT_CACHE_TTL)
+    return result
+
+
+# --- Tesseract warm-up ---
+def _warm_up_tesseract() -> None:
+    """
+    Runs one tiny OCR so the language data is already in the OS page cache when
+    the first real document arrives, instead of that request paying the cold start.
+    """
+    try:
+        run_ocr(np.full((32, 32), 255, np.uint8))
+    except Exception:
+        pass  # A missing Tesseract install is reported by the first real OCR call
+
+# In the background on the OCR pool (leaving a loaded API on that thread), so importing
+# this module isn't delayed. Skipped in worker processes, which import it only
+# through the re-run main script.
+if multiprocessing.parent_process() is None:
+    _OCR_POOL.submit(_warm_up_tesseract)